@@ -1,55 +1,86 @@
 #!/usr/bin/python3
 
 import argparse
-import glob
+import asyncio
+import errno
+import fcntl
 import os
-import pathlib
-import queue
 import shutil
+import stat
+import sys
 import threading
 import time
-import uuid
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Tuple
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 
 WORKING_SUFFIX = ".zfs-recompress"
+# Files up to this size are rewritten with a single read and write
+SMALL_FILE_SIZE = 4096
 
 
-def clear_line():
-    print(end="\x1B[2K\r")
+CLEAR_LINE = b"\x1B[2K\r"
 
 
-def should_skip_file(filename: str) -> bool:
-    if filename.endswith(WORKING_SUFFIX):
+def should_skip_file(filename: str, st: os.stat_result) -> bool:
+    # Work files of this and other runs, including stale ones from
+    # older versions that used a bare suffix
+    basename = os.path.basename(filename)
+    if basename.endswith(WORKING_SUFFIX) or WORKING_SUFFIX + "." in basename:
+        return True
+    # st comes from lstat(), so this also excludes symlinks
+    if not stat.S_ISREG(st.st_mode):
+        return True
+    return st.st_size <= 0
+
+
+def file_changed(st_1: os.stat_result, st_2: os.stat_result) -> bool:
+    return st_1.st_ino != st_2.st_ino or st_1.st_mtime_ns != st_2.st_mtime_ns
+
+
+FREE_SPACE_TTL = 2.0
+_free_cache: Dict[int, Tuple[float, int]] = {}
+_reserved: Dict[int, int] = {}
+_free_cache_lock = threading.Lock()
+
+
+def reserve_space(filename: str, dev: int, size: int) -> bool:
+    # Free space barely changes between files on the same filesystem,
+    # so cache it per device for a short while. The caller already has
+    # st_dev from its stat snapshot, saving a stat of the directory.
+    # Copies running concurrently reserve their size, so that they can't
+    # all pass the check against the same cached value
+    now = time.monotonic()
+    with _free_cache_lock:
+        cached = _free_cache.get(dev)
+        if cached is None or now - cached[0] >= FREE_SPACE_TTL:
+            total, used, free = shutil.disk_usage(filename)
+            cached = _free_cache[dev] = (now, free)
+        reserved = _reserved.get(dev, 0)
+        if size > cached[1] - reserved:
+            return False
+        _reserved[dev] = reserved + size
         return True
-    return get_file_size(filename) <= 0
 
 
-def get_file_size(filename: str) -> int:
-    if os.path.islink(filename):
-        # We don't process symlinks
-        return 0
-    if not os.path.isfile(filename):
-        return 0
-    return os.path.getsize(filename)
+def release_space(dev: int, size: int) -> None:
+    with _free_cache_lock:
+        _reserved[dev] -= size
 
 
-def get_free_space(filename: str) -> int:
-    total, used, free = shutil.disk_usage(filename)
-    return free
+SIZE_UNITS = ("B", "KiB", "MiB", "GiB", "TiB", "PiB")
 
 
 def format_size(size: int) -> str:
-    UNITS = ["B", "KiB", "MiB", "GiB", "TiB"]
-    for unit in UNITS:
-        if size >= 1024:
-            size /= 1024
-        else:
-            return f"{size:.2f} {unit}"
-    return f"{size:.2f} PiB"
-
-
-def gen_uuid() -> str:
-    return str(uuid.uuid4())
+    # Pick the unit from the bit length instead of dividing in a loop
+    e = min(max(0, (size.bit_length() - 1) // 10), len(SIZE_UNITS) - 1)
+    return f"{size / (1 << (e * 10)):.2f} {SIZE_UNITS[e]}"
 
 
 def force_rm(filename: str) -> None:
@@ -59,10 +90,101 @@ def force_rm(filename: str) -> None:
         pass
 
 
+COPY_FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
+
+
+_buf = threading.local()
+
+
+def _get_buffer() -> memoryview:
+    # Reuse one 1 MiB buffer per thread instead of allocating per file
+    mv = getattr(_buf, "mv", None)
+    if mv is None:
+        mv = _buf.mv = memoryview(bytearray(1 << 20))
+    return mv
+
+
+def _fallback_copy(sfd: int, dfd: int) -> None:
+    mv = _get_buffer()
+    while True:
+        n = os.readv(sfd, [mv])
+        if not n:
+            break
+        view = mv[:n]
+        while view:
+            view = view[os.writev(dfd, [view]):]
+
+
+def copy_fd(sfd: int, dfd: int, size: int) -> None:
+    # Don't use copy_file_range(): with OpenZFS block cloning it shares the
+    # original's block pointers, so nothing would actually be rewritten.
+    # sendfile() still copies the data, only without going through user space
+    remaining = size
+    # Only Linux sendfile() accepts a regular file as the destination and
+    # offset=None; on BSD it requires a socket
+    if hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+        try:
+            while remaining > 0:
+                n = os.sendfile(dfd, sfd, None, remaining)
+                if n == 0:
+                    break
+                remaining -= n
+            return
+        except OSError as e:
+            if e.errno not in COPY_FALLBACK_ERRNOS or remaining != size:
+                raise
+    _fallback_copy(sfd, dfd)
+
+
+def fadvise(fd: int, advice_name: str) -> None:
+    # One-shot sequential scan: ask for read-ahead, then drop the pages
+    # so the traversal doesn't evict everything else from the page cache
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice_name))
+    except OSError:
+        pass
+
+
 def cp_preserved(src: str, dst: str) -> None:
-    shutil.copy2(src, dst)
-    st = os.stat(src)
-    os.chown(dst, st.st_uid, st.st_gid)
+    sfd = os.open(src, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        fadvise(sfd, "POSIX_FADV_SEQUENTIAL")
+        dfd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o600)
+        try:
+            st = os.fstat(sfd)
+            copy_fd(sfd, dfd, st.st_size)
+            fadvise(sfd, "POSIX_FADV_DONTNEED")
+            fadvise(dfd, "POSIX_FADV_DONTNEED")
+            # chown before copystat, as chown may clear setuid/setgid bits
+            os.fchown(dfd, st.st_uid, st.st_gid)
+        finally:
+            os.close(dfd)
+    finally:
+        os.close(sfd)
+    # Like shutil.copy2: mode, xattrs (incl. ACLs and SELinux labels) and
+    # BSD file flags. Then restore the times from before our own read
+    shutil.copystat(src, dst)
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def recompress_in_place(fd: int, size: int) -> None:
+    # ZFS is copy-on-write, so writing every block back to where it came
+    # from stores it again under the current compression setting
+    mv = _get_buffer()
+    offset = 0
+    while offset < size:
+        n = os.preadv(fd, [mv], offset)
+        if not n:
+            break
+        view = mv[:n]
+        pos = offset
+        while view:
+            written = os.pwrite(fd, view, pos)
+            view = view[written:]
+            pos += written
+        offset += n
 
 
 def force_mv(src: str, dst: str) -> None:
@@ -79,91 +201,216 @@ def truncate_filename(filename: str, width: int = 24) -> str:
     return filename
 
 
-def process_file(filename: str) -> None:
-    if should_skip_file(filename):
+def rewrite_in_place(filename: str, st_before: os.stat_result) -> bool:
+    # Returns False if the file can't be opened for writing or locked, so
+    # that the caller falls back to copy+rename
+    try:
+        fd = os.open(filename, os.O_RDWR | os.O_CLOEXEC)
+    except OSError:
+        # e.g. ETXTBSY for running executables
+        return False
+    try:
+        try:
+            # Only keeps out writers that also use flock(), which is why
+            # in-place rewriting is opt-in
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Someone is writing to it. Renaming a copy over the file would
+            # orphan their later writes just the same, so leave it alone
+            raise OSError("File is locked by another process: {}".format(filename))
+        except OSError:
+            # flock() not supported here, fall back to copy+rename
+            return False
+        st = os.fstat(fd)
+        if file_changed(st_before, st):
+            raise OSError("File changed since scan: {}".format(filename))
+        if st.st_size <= SMALL_FILE_SIZE:
+            os.pwrite(fd, os.pread(fd, st.st_size, 0), 0)
+        else:
+            fadvise(fd, "POSIX_FADV_SEQUENTIAL")
+            recompress_in_place(fd, st.st_size)
+            fadvise(fd, "POSIX_FADV_DONTNEED")
+        # Our own writes move mtime, so only size can reveal another
+        # writer here. Don't restore timestamps over someone else's change
+        if os.fstat(fd).st_size != st.st_size:
+            raise OSError("File changed during rewrite: {}".format(filename))
+        os.utime(fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+    finally:
+        os.close(fd)
+    return True
+
+
+def process_file(filename: str, st_before: os.stat_result, in_place: bool = False) -> None:
+    # Callers only pass files that made it through should_skip_file()
+    if in_place and rewrite_in_place(filename, st_before):
         return
-    size = get_file_size(filename)
-    free = get_free_space(filename)
-    if size > free:
+
+    if not reserve_space(filename, st_before.st_dev, st_before.st_size):
         raise OSError("Not enough free space to process file: {}".format(filename))
 
     try:
-        workfilename = filename + WORKING_SUFFIX
-        st_1 = os.stat(filename)
+        # Tag with pid and thread so concurrent workers and runs can't collide
+        workfilename = f"{filename}{WORKING_SUFFIX}.{os.getpid()}.{threading.get_ident()}"
         cp_preserved(filename, workfilename)
-        st_2 = os.stat(filename)
-        if st_1.st_ino != st_2.st_ino or st_1.st_mtime != st_2.st_mtime:
+        if file_changed(st_before, os.lstat(filename)):
             raise OSError("File changed during copy: {}".format(filename))
         force_mv(workfilename, filename)
     finally:
         force_rm(workfilename)
+        release_space(st_before.st_dev, st_before.st_size)
 
 
 def handle_exception(e: Exception):
-    import traceback
-    traceback.print_exc()
+    traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
 
 
-def worker_thread(qin: queue.SimpleQueue, qout: queue.SimpleQueue):
-    while True:
-        filename = qin.get()
-        if filename is None:
-            return
-        size = get_file_size(filename)
-        qout.put((filename, size))
+def process_files(items: List[Tuple[str, os.stat_result]], in_place: bool) -> Tuple[str, int, int, int]:
+    # Process a batch in one go and report it as a whole, saving a thread
+    # handoff and a progress update per file
+    for filename, st in items:
         try:
-            process_file(filename)
+            process_file(filename, st, in_place)
         except Exception as e:
             handle_exception(e)
+    last_path, last_st = items[-1]
+    return last_path, last_st.st_size, len(items), sum(st.st_size for _, st in items)
 
 
-def spawn_worker(qin: queue.SimpleQueue, qout: queue.SimpleQueue) -> threading.Thread:
-    t = threading.Thread(target=worker_thread, args=(qin, qout), daemon=True)
-    t.start()
-    return t
+class Progress:
+    """Progress display, updated from the event loop thread only."""
 
+    def __init__(self):
+        self.out = sys.stdout.buffer
+        self.count = 0
+        self.total_size = 0
 
-def display_thread(qin: queue.SimpleQueue):
-    count, total_size = 0, 0
-    while True:
-        filename, size = qin.get()
-        if filename is None:
-            break
-        count += 1
-        total_size += size
-        if count % 10 == 0 or size >= 20 << 20:
+    def update(self, filename: str, size: int, count: int, batch_size: int) -> None:
+        # filename and size are the last file of a batch of count files
+        # totalling batch_size bytes. Large files always end their batch
+        prev_count = self.count
+        self.count += count
+        self.total_size += batch_size
+        if self.count // 10 != prev_count // 10 or size >= 20 << 20:
             # print every 10th file and anything larger than 20 MiB
+            # Emit the escape sequence and the text with a single write
             display_name = truncate_filename(filename, 24)
-            clear_line()
-            print(f"Processed {count}: {display_name:<24} ({format_size(size):>10} / {format_size(total_size):>10})", end="", flush=True)
-    clear_line()
-    print(f"Processed {count} files, {format_size(total_size)} total")
+            self.out.write(CLEAR_LINE + os.fsencode(f"Processed {self.count}: {display_name:<24} ({format_size(size):>10} / {format_size(self.total_size):>10})"))
+            self.out.flush()
 
-def get_files(path):
-    for p in pathlib.Path(path).glob("**/*"):
-        yield str(p)
+    def finish(self) -> None:
+        self.out.write(CLEAR_LINE + f"Processed {self.count} files, {format_size(self.total_size)} total\n".encode())
+        self.out.flush()
 
 
-def main() -> None:
-    NUM_THREADS = 4
-    cwd = os.getcwd()
-    qin = queue.SimpleQueue()
-    qout = queue.SimpleQueue()
-    t = threading.Thread(target=display_thread, args=(qout,), daemon=True)
-    t.start()
-    workers = []
-    for i in range(NUM_THREADS):
-        workers.append(spawn_worker(qin, qout))
-    for filename in get_files(cwd):
-        if should_skip_file(filename):
+def get_files(path: str) -> Iterator[Tuple[str, os.DirEntry]]:
+    # Yields the same files as os.walk(path, followlinks=False), though in
+    # a different order as it descends into directories as soon as it meets
+    # them. Keeps the DirEntry objects so that callers can use their cached
+    # stat results
+    stack = [os.scandir(path)]
+    try:
+        while stack:
+            entry = next(stack[-1], None)
+            if entry is None:
+                stack.pop().close()
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                try:
+                    stack.append(os.scandir(entry.path))
+                except FileNotFoundError:
+                    # Removed since its parent was listed
+                    pass
+                except OSError as e:
+                    # e.g. EACCES, or EMFILE on very deep trees
+                    print(f"Skipping directory {entry.path}: {e}", file=sys.stderr)
+            else:
+                yield entry.path, entry
+    finally:
+        for it in stack:
+            it.close()
+
+
+def get_work_items(path: str, in_place: bool) -> Iterator[Tuple[str, os.stat_result]]:
+    # Hard-linked files are met once per link. Rewriting in place needs to
+    # happen once per inode, while copy+rename would split the links and
+    # leave the other names with the old data, so those are skipped
+    seen_links = set()
+    for filename, entry in get_files(path):
+        # Skip anything that isn't a regular file before paying for lstat()
+        if not entry.is_file(follow_symlinks=False):
+            continue
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except OSError:
+            continue
+        if should_skip_file(filename, st):
             continue
-        qin.put(filename)
-    for i in range(NUM_THREADS):
-        qin.put(None)
-    for w in workers:
-        w.join()
-    qout.put((None, 0))
-    t.join()
+        if st.st_nlink > 1:
+            if not in_place:
+                print(f"Skipping hard-linked file {filename}, use --in-place to process it", file=sys.stderr)
+                continue
+            key = (st.st_dev, st.st_ino)
+            if key in seen_links:
+                continue
+            seen_links.add(key)
+        yield filename, st
+
+
+async def run(path: str, in_place: bool) -> None:
+    NUM_CONCURRENT = 32
+    BATCH_SIZE = 10
+    # asyncio.to_thread() uses the default executor, which must be large
+    # enough to actually run NUM_CONCURRENT batches at once, plus the walk
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=NUM_CONCURRENT + 1))
+    # The semaphore bounds the batches in flight, so the walk doesn't run
+    # ahead of the copies and hold the whole tree in memory
+    sem = asyncio.Semaphore(NUM_CONCURRENT)
+    progress = Progress()
+    tasks = set()
+
+    async def process(items: List[Tuple[str, os.stat_result]]) -> None:
+        try:
+            result = await asyncio.to_thread(process_files, items, in_place)
+        finally:
+            sem.release()
+        progress.update(*result)
+
+    async def submit(items: List[Tuple[str, os.stat_result]]) -> None:
+        await sem.acquire()
+        task = asyncio.create_task(process(items))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    def walk() -> None:
+        # The walk and its lstat() calls run off the event loop, so that
+        # batches start and finish while the tree is still being scanned.
+        # Waiting for submit() blocks the walk while all slots are busy
+        batch = []
+        for filename, st in get_work_items(path, in_place):
+            batch.append((filename, st))
+            # Hand off every 10 files, and large files right away
+            if len(batch) >= BATCH_SIZE or st.st_size >= 20 << 20:
+                asyncio.run_coroutine_threadsafe(submit(batch), loop).result()
+                batch = []
+        if batch:
+            asyncio.run_coroutine_threadsafe(submit(batch), loop).result()
+
+    await asyncio.to_thread(walk)
+    await asyncio.gather(*tasks)
+    progress.finish()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Rewrite files in the current directory so that ZFS stores them under the current compression setting")
+    parser.add_argument("--in-place", action="store_true",
+                        help="rewrite files in place instead of copying and renaming them; "
+                        "faster, but writes made by other programs during the rewrite may be lost")
+    args = parser.parse_args()
+    if uvloop is not None:
+        uvloop.run(run(os.getcwd(), args.in_place))
+    else:
+        asyncio.run(run(os.getcwd(), args.in_place))
 
 
 if __name__ == "__main__":